@@ -1,8 +1,15 @@
 import os
-import copy
+import re
+import sys
+import hashlib
 import time
+import random
+import asyncio
+import logging
+import functools
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
+import orjson
 from time_trigger_task import task_io
 
 # === 配置区域 ===
@@ -12,154 +19,376 @@ TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 ENV_KEY_NAME = "DEVICE_KEYS"
 MAX_RETRIES = 3
 RETRY_DELAY = 2
+MAX_DELAY = 60
+REQUEST_TIMEOUT = 20
+MAX_CONCURRENCY = 16
+EXECUTED_INDEX = os.path.join(CONFIG_DIR, ".executed_index.json")
+# 只有这些状态码值得重试; 4xx 配置错误重试多少次都不会成功
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# 日志: 级别由 LOG_LEVEL 环境变量控制, 被门控的日志不会做任何字符串格式化
+logger = logging.getLogger("time_trigger_task")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+
+# 可选的文件名时间戳前缀: YYYYMMDD-HHMMSS-<名称>.json
+_FILENAME_TS = re.compile(r"^(\d{8}-\d{6})-")
+
+
+def filename_epoch(path):
+    """从文件名前缀提取触发时间戳 (默认北京时间), 无前缀返回 None"""
+    m = _FILENAME_TS.match(os.path.basename(path))
+    if not m:
+        return None
+    try:
+        naive = datetime.strptime(m.group(1), "%Y%m%d-%H%M%S")
+    except ValueError:
+        return None
+    return naive.replace(tzinfo=get_timezone("Asia/Shanghai")).timestamp()
+
+
+def json_clone(value):
+    """递归拷贝纯 JSON 结构 (dict/list/标量)。
+
+    配置数据没有环引用和自定义类, 不需要 copy.deepcopy 的 memo 表
+    和类型分发, 直接递归重建要快好几倍。
+    """
+    if isinstance(value, dict):
+        return {k: json_clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [json_clone(v) for v in value]
+    return value
+
+
+def load_executed_index():
+    """读取已执行任务索引: path -> {size, sha256}。缺失或损坏时视为空"""
+    try:
+        with open(EXECUTED_INDEX, "rb") as f:
+            index = orjson.loads(f.read())
+        return index if isinstance(index, dict) else {}
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+
+def save_executed_index(index):
+    """原子写回索引 (tmp + rename), 避免 cron 中断留下半个文件"""
+    tmp = EXECUTED_INDEX + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(index, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, EXECUTED_INDEX)
+
+
+def index_entry(path):
+    """生成索引条目: 文件大小 + 内容哈希。
+
+    GitHub Actions 每次运行都是 fresh checkout, mtime 会被重置,
+    所以索引只能依赖内容本身才能跨 runner 生效。
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    return {"size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest()}
+
+
+# 解析结果缓存: path -> (mtime_ns, parsed)。文件未变时跳过重复的读取+JSON解析
+_CFG_CACHE = {}
+
+
+def read_config_cached(path):
+    """按 mtime 缓存 task_io.read_config 的结果, 命中时只剩一次 stat"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    hit = _CFG_CACHE.get(path)
+    if hit is not None and hit[0] == mtime_ns:
+        return json_clone(hit[1])
+    # ✅ 调用 Rust: 安全读取并解析 JSON
+    data = task_io.read_config(path)
+    _CFG_CACHE[path] = (mtime_ns, data)
+    # 返回拷贝, 保证调用方的修改不会污染缓存
+    return json_clone(data)
+
+
+def write_config_atomic(path, data):
+    """原子写回单个配置 (tmp + rename)"""
+    tmp = path + ".tmp"
+    # ✅ 调用 Rust: 序列化并写入临时文件, rename 保证原子性
+    task_io.save_config(tmp, data)
+    os.replace(tmp, path)
+
+
+def emit_log(lines):
+    """把一个任务攒下的全部日志行作为单条记录一次性写出"""
+    logger.info("%s", "\n".join(lines))
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_keys(raw):
+    return orjson.loads(raw)
 
 
 def load_secret_keys():
-    """从环境变量加载 Keys"""
-    import json
+    """从环境变量加载 Keys (按原始字符串缓存解析结果)"""
     keys_str = os.environ.get(ENV_KEY_NAME, "[]")
     try:
-        keys = json.loads(keys_str)
-        print(f"🔐 已加载 Keys 配置 (类型: {type(keys).__name__})")
+        keys = _parse_keys(keys_str)
+        logger.info("🔐 已加载 Keys 配置 (类型: %s)", type(keys).__name__)
         return keys
-    except json.JSONDecodeError:
-        print(f"⚠️ 警告: 环境变量 {ENV_KEY_NAME} JSON 格式错误")
+    except orjson.JSONDecodeError:
+        logger.warning("⚠️ 警告: 环境变量 %s JSON 格式错误", ENV_KEY_NAME)
         return []
 
 
+# 时区对象缓存: 构造 ZoneInfo 需要读取系统 tz 数据, 每个时区只做一次
+_TZ_CACHE = {}
+
+
+def get_timezone(tz_name):
+    tz = _TZ_CACHE.get(tz_name)
+    if tz is None:
+        try:
+            tz = ZoneInfo(tz_name)
+        except Exception:
+            logger.warning("⚠️ 时区 '%s' 无效，使用 UTC", tz_name)
+            tz = ZoneInfo("UTC")
+        _TZ_CACHE[tz_name] = tz
+    return tz
+
+
 def get_current_time(tz_name="Asia/Shanghai"):
-    try:
-        tz = pytz.timezone(tz_name)
-        return datetime.now(tz)
-    except Exception:
-        print(f"⚠️ 时区 '{tz_name}' 无效，使用 UTC")
-        return datetime.now(pytz.utc)
+    return datetime.now(get_timezone(tz_name))
 
 
-def process_tasks():
+async def dispatch(task, semaphore):
+    """并发发送单个到期任务 (带重试), 日志攒在本地最后一次性输出"""
+    config_file, data, payload, url, method, current_time = task
+    # 幂等键: 由文件名+触发时间派生, 同一任务的所有重试共享同一个键,
+    # 服务端据此去重, 崩溃后的重复发送不会造成二次触发
+    idem_key = hashlib.sha256(
+        f"{config_file}:{data.get('trigger_time')}".encode()).hexdigest()
+    headers = {"Idempotency-Key": idem_key}
+    log = []
+    async with semaphore:
+        success = False
+        for attempt in range(1, MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                log.append(
+                    f"   📡 (Rust内核) 发送请求: {config_file} (尝试 {attempt}/{MAX_RETRIES})")
+
+                # ✅ 调用 Rust: 发送 HTTP 请求 (阻塞调用放入线程池, 避免卡住事件循环)
+                # 参数: method, url, payload, timeout(秒)
+                # 返回: (status_code, body_text, retry_after)
+                status_code, resp_text, retry_after = await asyncio.to_thread(
+                    task_io.send_request,
+                    method,
+                    url,
+                    payload,
+                    REQUEST_TIMEOUT,
+                    headers,
+                )
+
+                if 200 <= status_code < 300:
+                    log.append(f"   ✅ 发送成功: {config_file} | 状态码: {status_code}")
+                    success = True
+                    break
+                elif status_code in RETRYABLE_STATUS:
+                    log.append(f"   ⚠️ 失败: {config_file} 服务器返回 {status_code}")
+                    # 可选: 记录返回内容帮助调试
+                    # log.append(f"      响应: {resp_text[:100]}...")
+                else:
+                    # 400/401/404 之类的配置错误, 重试只会白等超时
+                    log.append(
+                        f"   ⛔️ 失败: {config_file} 服务器返回 {status_code} (不可重试)")
+                    break
+
+            except Exception as req_err:
+                # Rust 抛出的 PyConnectionError 等异常会在这里被捕获
+                # 走 logger 的惰性格式化: 级别被门控时异常不会被 str 化
+                logger.warning(
+                    "   ❌ (Rust内核) 网络异常: %s [%s]", req_err, config_file)
+
+            if attempt < MAX_RETRIES:
+                if retry_after is not None:
+                    # 服务端明确给了 Retry-After, 按它等 (仍受上限约束)
+                    delay = min(MAX_DELAY, retry_after)
+                else:
+                    # 指数退避 + 全抖动: 避免多个任务(或多次 cron)同步重试造成雪崩
+                    delay = random.uniform(
+                        0, min(MAX_DELAY, RETRY_DELAY * (2 ** (attempt - 1))))
+                await asyncio.sleep(delay)
+
+        if not success:
+            log.append(f"   ⛔️ 最终失败: {config_file}")
+        emit_log(log)
+        return success
+
+
+async def process_tasks():
     secret_keys = load_secret_keys()
     # ✅ 调用 Rust: 极速扫描文件列表
     config_files = task_io.list_configs(CONFIG_DIR)
 
     if not config_files:
-        print("💤 没有找到配置文件。")
+        logger.info("💤 没有找到配置文件。")
         return
-    files_changed = False
+    executed_index = load_executed_index()
+    index_dirty = False
+    # 整个扫描共用一个 now, 窗口判断退化为整数秒比较
+    now_epoch = time.time()
+    # 第一阶段: 串行筛选出到期任务, 准备好各自的 payload
+    due_tasks = []
     for config_file in config_files:
-        print(f"\n📄 检查任务: {config_file}")
+        # 索引命中且文件未被改动: 不用做 JSON 解析就能确定已执行。
+        # 大小不同直接视为已变; 大小相同再读内容比对哈希
+        # (文件可能在扫描和 stat 之间被并发运行/auto-commit 删掉, 跳过即可)
         try:
-            # ✅ 调用 Rust: 安全读取并解析 JSON
-            data = task_io.read_config(config_file)
-        except Exception as e:
-            print(f"   ❌ (Rust内核) 读取失败: {e}")
+            st_size = os.stat(config_file).st_size
+        except OSError as e:
+            logger.warning("   ❌ 读取失败: %s [%s]", e, config_file)
             continue
-        if data.get("executed") is True:
-            print("   ⏭️ 跳过: 任务已标记为已执行")
-            continue
-
-        trigger_time_str = data.get("trigger_time")
-        tz_name = data.get("timezone", "Asia/Shanghai")
-        if not trigger_time_str:
+        hit = executed_index.get(config_file)
+        if isinstance(hit, dict) and hit.get("size") == st_size:
+            try:
+                with open(config_file, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except OSError as e:
+                logger.warning("   ❌ 读取失败: %s [%s]", e, config_file)
+                continue
+            if digest == hit.get("sha256"):
+                continue
+        # 文件名自带时间戳的任务可以不开文件就剪枝 (留 1 天余量覆盖时区差异)
+        fn_epoch = filename_epoch(config_file)
+        if fn_epoch is not None and (
+                fn_epoch < now_epoch - TOLERANCE_MINUTES * 60 - 86400
+                or fn_epoch > now_epoch + 86400):
             continue
+        # 每个任务的日志先攒在列表里, finally 中一次性输出 (continue 也会触发)
+        log = [f"\n📄 检查任务: {config_file}"]
         try:
-            target_tz = pytz.timezone(tz_name)
-            naive_trigger_time = datetime.strptime(
-                trigger_time_str, TIME_FORMAT)
-            trigger_time = target_tz.localize(naive_trigger_time)
-            current_time = get_current_time(tz_name)
-        except ValueError as e:
-            print(f"   ❌ 时间格式错误: {e}")
-            continue
-        diff = current_time - trigger_time
-        diff_minutes = diff.total_seconds() / 60
-        print(
-            f"   ⏳ 设定: {trigger_time} | 当前: {current_time.strftime('%H:%M:%S')}")
-        print(f"   ⏳ 延迟: {diff_minutes:.1f} 分钟")
-        if 0 <= diff_minutes <= TOLERANCE_MINUTES:
-            print("   🚀 准备执行...")
-
-            url = data.get("webhook_url")
-            method = data.get("method", "POST").upper()
-            payload = copy.deepcopy(data.get("body", {}))
-
-            if "device_keys" not in payload:
-                payload["device_keys"] = []
-
-            # --- 注入 Key 逻辑 (保持 Python 处理灵活性) ---
-            if isinstance(secret_keys, list) and secret_keys:
-                print(f"      注入 {len(secret_keys)} 个 Keys (追加模式)")
-                payload["device_keys"] = list(
-                    set(payload["device_keys"] + secret_keys))
-            elif isinstance(secret_keys, dict):
-                original_list = payload["device_keys"]
-                resolved_list = []
-                if not original_list and secret_keys:
-                    print("      配置为空，注入 Secret 中所有 Keys")
-                    resolved_list = list(secret_keys.values())
-                else:
-                    for item in original_list:
-                        if item in secret_keys:
-                            print(f"      替换别名 '{item}' -> Masked Key")
-                            resolved_list.append(secret_keys[item])
-                        else:
-                            resolved_list.append(item)
-                payload["device_keys"] = resolved_list
-
-            # --- 发送请求 (替换为 Rust 绑定) ---
-            success = False
-            for attempt in range(1, MAX_RETRIES + 1):
+            try:
+                data = read_config_cached(config_file)
+            except Exception as e:
+                log.append(f"   ❌ (Rust内核) 读取失败: {e}")
+                continue
+            if data.get("executed") is True:
+                log.append("   ⏭️ 跳过: 任务已标记为已执行")
+                # 补录进索引, 下次 cron 连 JSON 解析都省掉
+                # (条目没变就不标脏, 避免每次运行都重写并提交索引文件)
                 try:
-                    print(
-                        f"      📡 (Rust内核) 发送请求... (尝试 {attempt}/{MAX_RETRIES})")
-
-                    # ✅ 调用 Rust: 发送 HTTP 请求
-                    # 参数: method, url, payload, timeout(秒)
-                    # 返回: (status_code, body_text)
-                    status_code, resp_text = task_io.send_request(
-                        method,
-                        url,
-                        payload,
-                        20  # timeout
-                    )
-
-                    if 200 <= status_code < 300:
-                        print(f"   ✅ 发送成功! 状态码: {status_code}")
-                        success = True
-                        break
-                    else:
-                        print(f"   ⚠️ 失败: 服务器返回 {status_code}")
-                        # 可选: 打印返回内容帮助调试
-                        # print(f"      响应: {resp_text[:100]}...")
-
-                except Exception as req_err:
-                    # Rust 抛出的 PyConnectionError 等异常会在这里被捕获
-                    print(f"   ❌ (Rust内核) 网络异常: {req_err}")
-
-                if attempt < MAX_RETRIES:
-                    time.sleep(RETRY_DELAY)
-
-            if success:
-                data["executed"] = True
-                data["executed_at"] = current_time.strftime(TIME_FORMAT)
-                try:
-                    # ✅ 调用 Rust: 将更新后的数据写回磁盘
-                    task_io.save_config(config_file, data)
-                    print("   💾 状态已更新并保存 (Rust内核)")
-                    files_changed = True
-                except Exception as e:
-                    print(f"   ❌ (Rust内核) 保存失败: {e}")
+                    entry = index_entry(config_file)
+                except OSError:
+                    entry = None
+                if entry is not None \
+                        and executed_index.get(config_file) != entry:
+                    executed_index[config_file] = entry
+                    index_dirty = True
+                continue
+
+            trigger_time_str = data.get("trigger_time")
+            tz_name = data.get("timezone", "Asia/Shanghai")
+            if not trigger_time_str:
+                continue
+            try:
+                naive_trigger_time = datetime.strptime(
+                    trigger_time_str, TIME_FORMAT)
+                trigger_epoch = naive_trigger_time.replace(
+                    tzinfo=get_timezone(tz_name)).timestamp()
+            except ValueError as e:
+                log.append(f"   ❌ 时间格式错误: {e}")
+                continue
+            # 统一和循环外取好的 now_epoch 比较, 避免每个任务各做一次 tz 感知运算
+            diff_seconds = now_epoch - trigger_epoch
+            log.append(f"   ⏳ 设定: {trigger_time_str} ({tz_name})")
+            log.append(f"   ⏳ 延迟: {diff_seconds / 60:.1f} 分钟")
+            if 0 <= diff_seconds <= TOLERANCE_MINUTES * 60:
+                log.append("   🚀 加入发送队列...")
+
+                url = data.get("webhook_url")
+                method = data.get("method", "POST").upper()
+                # 配置缺 URL 的任务反正发不出去, 不值得为它构建 payload
+                if not url:
+                    log.append("   ❌ 跳过: 缺少 webhook_url")
+                    continue
+
+                # ✅ 调用 Rust: 克隆 body 并一次性完成 Key 注入/去重/别名替换
+                payload = task_io.build_payload(
+                    data.get("body", {}), secret_keys)
+                if isinstance(secret_keys, list) and secret_keys:
+                    log.append(f"      注入 {len(secret_keys)} 个 Keys (追加模式)")
+                elif isinstance(secret_keys, dict) and secret_keys:
+                    log.append("      已按 Secret 映射解析 device_keys")
+
+                current_time = get_current_time(tz_name)
+                due_tasks.append(
+                    (config_file, data, payload, url, method, current_time))
             else:
-                print(f"   ⛔️ 最终失败")
-        else:
-            if diff_minutes < 0:
-                print("   zzz 时间未到")
+                if diff_seconds < 0:
+                    log.append("   zzz 时间未到")
+                else:
+                    log.append(f"   🚫 已过期 (超过 {TOLERANCE_MINUTES} 分钟)")
+        finally:
+            emit_log(log)
+
+    if not due_tasks:
+        if index_dirty:
+            save_executed_index(executed_index)
+        logger.info("\n🏁 无状态变更。")
+        return
+
+    # 第二阶段: 发送前先落盘 executed 标记。崩溃时宁可漏发一次 (下次人工恢复),
+    # 也不能重复触发; 配合幂等键, 服务端还能对重复发送去重
+    for config_file, data, _, _, _, current_time in due_tasks:
+        data["executed"] = True
+        data["executed_at"] = current_time.strftime(TIME_FORMAT)
+        try:
+            write_config_atomic(config_file, data)
+        except Exception as e:
+            logger.error("   ❌ (Rust内核) 预标记失败: %s", e)
+
+    # 第三阶段: 并发发送 (Semaphore 限制同时在途的请求数)
+    logger.info("\n🚀 并发执行 %d 个到期任务...", len(due_tasks))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    results = await asyncio.gather(
+        *(dispatch(task, semaphore) for task in due_tasks))
+
+    # 第四阶段: 成功的已在发送前标记完毕, 只需回滚最终失败的任务
+    files_changed = False
+    for task, success in zip(due_tasks, results):
+        config_file, data, _, _, _, current_time = task
+        if success:
+            logger.info("   💾 状态已确认 (Rust内核): %s", config_file)
+            files_changed = True
+            # 发送阶段可能跑了几分钟, 文件同样可能已被并发运行删掉;
+            # 索引更新失败只能降级, 绝不能中断后面任务的回滚
+            try:
+                entry = index_entry(config_file)
+            except OSError as e:
+                logger.warning("   ⚠️ 索引更新失败: %s [%s]", e, config_file)
             else:
-                print(f"   🚫 已过期 (超过 {TOLERANCE_MINUTES} 分钟)")
+                if executed_index.get(config_file) != entry:
+                    executed_index[config_file] = entry
+                    index_dirty = True
+            continue
+        data["executed"] = False
+        data.pop("executed_at", None)
+        try:
+            write_config_atomic(config_file, data)
+            logger.info("   ↩️ 已回滚执行标记, 等待下次 cron 重试: %s", config_file)
+        except Exception as e:
+            logger.error("   ❌ (Rust内核) 回滚失败: %s", e)
+    if index_dirty:
+        save_executed_index(executed_index)
+
     if files_changed:
-        print("\n🏁 有状态更新。")
+        logger.info("\n🏁 有状态更新。")
     else:
-        print("\n🏁 无状态变更。")
+        logger.info("\n🏁 无状态变更。")
 
 
 if __name__ == "__main__":
-    process_tasks()
+    # CI 下 stdout 是行缓冲 (每行一个 syscall), 改成块缓冲
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    asyncio.run(process_tasks())
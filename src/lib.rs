@@ -1,19 +1,34 @@
-use glob::glob;
 use pyo3::prelude::*;
 use serde_json::Value;
 use std::fs;
+use std::sync::OnceLock;
 
-// 1. 扫描目录获取 .json 文件列表 (保持不变)
+// 全局复用的 HTTP Client: 连接池 + keep-alive, 避免每次请求重建 TCP/TLS
+fn http_client() -> &'static reqwest::blocking::Client {
+    static CLIENT: OnceLock<reqwest::blocking::Client> = OnceLock::new();
+    CLIENT.get_or_init(|| {
+        reqwest::blocking::Client::builder()
+            .pool_max_idle_per_host(32)
+            .user_agent("time-trigger-task/1.0")
+            .build()
+            .expect("构建 HTTP Client 失败")
+    })
+}
+
+// 1. 扫描目录获取 .json 文件列表
+// 直接 read_dir 按扩展名过滤, 不再做 glob 模式匹配; 隐藏文件 (如索引) 一并跳过
 #[pyfunction]
 fn list_configs(dir: String) -> PyResult<Vec<String>> {
-    let pattern = format!("{}/*.json", dir);
     let mut files = Vec::new();
-    if let Ok(paths) = glob(&pattern) {
-        for entry in paths {
-            if let Ok(path) = entry {
-                if let Some(path_str) = path.to_str() {
-                    files.push(path_str.to_string());
-                }
+    if let Ok(entries) = fs::read_dir(&dir) {
+        for entry in entries.flatten() {
+            let name = entry.file_name();
+            let name = name.to_string_lossy();
+            if name.starts_with('.') || !name.ends_with(".json") {
+                continue;
+            }
+            if let Some(path_str) = entry.path().to_str() {
+                files.push(path_str.to_string());
             }
         }
     }
@@ -52,29 +67,79 @@ fn save_config(path: String, data: PyObject, py: Python) -> PyResult<()> {
     Ok(())
 }
 
-// 4. 新增: 发送 HTTP 请求
-// 参数: method (GET/POST), url, payload (字典), timeout (秒)
-// 返回: (status_code, response_text) 的元组
+// 4. 构建发送 payload: 克隆 body 并完成 device_keys 合并
+// secret_keys 为数组 => 追加模式 (去重且保持首次出现顺序)
+// secret_keys 为对象 => 别名替换模式 (配置为空时注入全部 Keys)
+#[pyfunction]
+fn build_payload(body: PyObject, secret_keys: PyObject, py: Python) -> PyResult<PyObject> {
+    let mut body_v: Value = pythonize::depythonize(body.as_ref(py)).map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Body 转换失败: {}", e))
+    })?;
+    let keys_v: Value = pythonize::depythonize(secret_keys.as_ref(py)).map_err(|e| {
+        PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Keys 转换失败: {}", e))
+    })?;
+
+    if !body_v.is_object() {
+        body_v = Value::Object(serde_json::Map::new());
+    }
+    let obj = body_v.as_object_mut().unwrap();
+    let existing = match obj.remove("device_keys") {
+        Some(Value::Array(list)) => list,
+        _ => Vec::new(),
+    };
+
+    let merged: Vec<Value> = match keys_v {
+        Value::Array(list) if !list.is_empty() => {
+            let mut seen = std::collections::HashSet::new();
+            let mut out = Vec::new();
+            for v in existing.into_iter().chain(list.into_iter()) {
+                if seen.insert(v.to_string()) {
+                    out.push(v);
+                }
+            }
+            out
+        }
+        Value::Object(map) => {
+            if existing.is_empty() && !map.is_empty() {
+                map.values().cloned().collect()
+            } else {
+                existing
+                    .into_iter()
+                    .map(|v| match v.as_str().and_then(|s| map.get(s)) {
+                        Some(hit) => hit.clone(),
+                        None => v,
+                    })
+                    .collect()
+            }
+        }
+        _ => existing,
+    };
+    obj.insert("device_keys".to_string(), Value::Array(merged));
+
+    pythonize::pythonize(py, &body_v)
+        .map_err(|e| PyErr::new::<pyo3::exceptions::PyValueError, _>(e.to_string()))
+}
+
+// 5. 发送 HTTP 请求
+// 参数: method (GET/POST), url, payload (字典), timeout (秒), 可选自定义请求头
+// 返回: (status_code, response_text, retry_after秒数或None) 的元组
 #[pyfunction]
+#[pyo3(signature = (method, url, payload, timeout_secs, headers=None))]
 fn send_request(
     method: String,
     url: String,
     payload: PyObject,
     timeout_secs: u64,
+    headers: Option<std::collections::HashMap<String, String>>,
     py: Python,
-) -> PyResult<(u16, String)> {
+) -> PyResult<(u16, String, Option<u64>)> {
     // 1. 将 Python Payload 转为 Rust JSON Value
     let json_payload: Value = pythonize::depythonize(payload.as_ref(py)).map_err(|e| {
         PyErr::new::<pyo3::exceptions::PyValueError, _>(format!("Payload 转换失败: {}", e))
     })?;
 
-    // 2. 构建 Client
-    let client = reqwest::blocking::Client::builder()
-        .timeout(std::time::Duration::from_secs(timeout_secs))
-        .build()
-        .map_err(|e| {
-            PyErr::new::<pyo3::exceptions::PyRuntimeError, _>(format!("构建 Client 失败: {}", e))
-        })?;
+    // 2. 获取共享 Client (超时改为按请求设置)
+    let client = http_client();
 
     // 3. 构建请求
     let method_upper = method.to_uppercase();
@@ -97,17 +162,35 @@ fn send_request(
         }
     };
 
-    // 4. 发送请求
-    let response = request_builder.send().map_err(|e| {
-        // 将 reqwest 错误转换为 Python 异常
-        PyErr::new::<pyo3::exceptions::PyConnectionError, _>(format!("网络请求失败: {}", e))
-    })?;
+    // 4. 附加自定义请求头 (如 Idempotency-Key)
+    let mut request_builder = request_builder.timeout(std::time::Duration::from_secs(timeout_secs));
+    if let Some(extra) = headers {
+        for (k, v) in extra {
+            request_builder = request_builder.header(k.as_str(), v.as_str());
+        }
+    }
+
+    // 5. 发送并读取结果。Python 对象的转换已全部完成, 网络 I/O 期间释放 GIL,
+    //    否则并发的 dispatch 线程会被这里完全串行化
+    let result: Result<(u16, String, Option<u64>), String> = py.allow_threads(move || {
+        let response = request_builder
+            .send()
+            .map_err(|e| format!("网络请求失败: {}", e))?;
+
+        let status = response.status().as_u16();
+        // Retry-After 只认整数秒形式, HTTP 日期形式忽略
+        let retry_after = response
+            .headers()
+            .get(reqwest::header::RETRY_AFTER)
+            .and_then(|v| v.to_str().ok())
+            .and_then(|s| s.trim().parse::<u64>().ok());
+        let text = response.text().unwrap_or_default();
 
-    // 5. 获取结果
-    let status = response.status().as_u16();
-    let text = response.text().unwrap_or_default();
+        Ok((status, text, retry_after))
+    });
 
-    Ok((status, text))
+    // 将 reqwest 错误转换为 Python 异常
+    result.map_err(|e| PyErr::new::<pyo3::exceptions::PyConnectionError, _>(e))
 }
 
 #[pymodule]
@@ -115,6 +198,7 @@ fn task_io(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(list_configs, m)?)?;
     m.add_function(wrap_pyfunction!(read_config, m)?)?;
     m.add_function(wrap_pyfunction!(save_config, m)?)?;
+    m.add_function(wrap_pyfunction!(build_payload, m)?)?;
     // 注册新函数
     m.add_function(wrap_pyfunction!(send_request, m)?)?;
     Ok(())